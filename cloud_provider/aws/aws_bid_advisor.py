@@ -1,13 +1,14 @@
 """BidAdvisor implementation for AWS."""
 
-import csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import json
 import logging
+import random
 import threading
 import time
 
 import boto3
-import requests
 from retrying import retry
 from constants import SECONDS_PER_MINUTE
 
@@ -18,12 +19,14 @@ logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s " +
 logger = logging.getLogger("aws.minion-manager.bid-advisor")
 
 # Info about AWS Pricing API:
-# https://aws.amazon.com/blogs/aws/new-aws-price-list-api/
-# Info about reading the csv:
-# http://docs.aws.amazon.com/awsaccountbilling/latest/aboutv2/reading-an-offer.html
-AWS_PRICING_URL = 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.csv'
-HOURLY_TERM_CODE = 'JRTCKXETXF'
-RATE_CODE = '6YS6EN2CT7'
+# https://docs.aws.amazon.com/awsaccountbilling/latest/aboutv2/using-pelong.html
+# The Pricing API endpoint is only available in a couple of regions
+# (us-east-1 and ap-south-1), irrespective of the region being priced.
+AWS_PRICING_API_REGION = 'us-east-1'
+
+# On-demand pricing is fetched per instance family, with these many Pricing
+# API requests in flight at a time.
+PRICING_API_MAX_WORKERS = 8
 
 # The pricing API provided above only uses long region names and not the short
 # one (like us-west-2). And, there
@@ -51,6 +54,24 @@ AWS_REGIONS = {
 # spot-instance price and on-demand price.
 DEFAULT_BID = {"type": "on-demand"}
 
+# If fetching pricing info fails, the updaters retry after RETRY_INTERVAL
+# seconds. The interval is doubled on every consecutive failure, up to
+# MAX_RETRY_INTERVAL.
+RETRY_INTERVAL = 2 * SECONDS_PER_MINUTE
+MAX_RETRY_INTERVAL = 30 * SECONDS_PER_MINUTE
+
+# While waiting for the initial pricing info, AWSBidAdvisor.run() logs a
+# message every INITIAL_DATA_LOG_INTERVAL seconds.
+INITIAL_DATA_LOG_INTERVAL = 10
+
+
+def jittered(interval):
+    """
+    Returns the interval randomly adjusted by up to 10%, so that multiple
+    minion-managers don't hit the AWS APIs at the same time.
+    """
+    return interval * random.uniform(0.9, 1.1)
+
 
 class AWSBidAdvisor(object):
     """
@@ -64,20 +85,27 @@ class AWSBidAdvisor(object):
                  region):
         # This dictionary stores pricing information about on-demand instances
         # for all instance types.
-        # E.g. {'d2.2xlarge': '1.3800000000', 'g2.8xlarge': '2.6000000000',
-        # 'm3.large': '0.1330000000',...}
+        # E.g. {'d2.2xlarge': 1.38, 'g2.8xlarge': 2.6, 'm3.large': 0.133,...}
         self.on_demand_price_dict = {}
 
         # This list stores pricing information obtained from AWS. This
-        # includes AZ, instance-type, price. Also, this list is sorted by time
-        # and has guaranteed 1000 elements.
+        # includes AZ, instance-type, price. Also, this list is sorted by time,
+        # newest first, and covers the last hour.
         # [{'Timestamp': datetime.datetime(2017, 1, 10, 21, 55, 29,
         # tzinfo=tzutc()), 'ProductDescription': 'Linux/UNIX', 'InstanceType':
         # 'c3.2xlarge', 'SpotPrice': '0.089100', 'AvailabilityZone':
         # 'us-west-2a'}, ...]
         self.spot_price_list = []
 
+        # This dictionary indexes the latest spot price in spot_price_list by
+        # (instance-type, AZ). It is rebuilt whenever spot_price_list is
+        # refreshed and is used for looking up spot prices.
+        # E.g. {('c3.2xlarge', 'us-west-2a'): 0.0891, ...}
+        self.spot_price_index = {}
+
         self.ec2 = boto3.Session().client('ec2', region_name=region)
+        self.pricing = boto3.Session().client(
+            'pricing', region_name=AWS_PRICING_API_REGION)
 
         # The interval at which the on-demand pricing information should be
         # refreshed. The on-demand pricing doesn't change often. It should be
@@ -89,11 +117,29 @@ class AWSBidAdvisor(object):
         # interval therefore should be in the order of few minutes.
         self.spot_refresh_interval = spot_refresh_interval
 
+        # This dictionary caches the bids returned by get_new_bid() till the
+        # next spot-price refresh. It maps (instance-type, frozenset(zones))
+        # to (expiry time, bid_info). Writes are serialized by bid_cache_lock,
+        # reads don't take the lock.
+        self.bid_cache = {}
+        self.bid_cache_lock = threading.Lock()
+
         self.region = region
         self.terminate_thread = False
+        # Set on shutdown to wake up the updater threads from their sleep.
+        self.shutdown_event = threading.Event()
+        # Set by the updater threads once both on-demand and spot pricing
+        # info is available.
+        self.initial_data_event = threading.Event()
         self.all_bid_advisor_threads = []
+        # Serializes starting and stopping the updater threads.
+        self.threads_lock = threading.Lock()
 
-        self.lock = threading.Lock()
+        # Note: The updater threads never modify on_demand_price_dict or
+        # spot_price_list in place. They build new objects and rebind the
+        # attributes, which is atomic. Readers therefore don't need a lock as
+        # long as they read each attribute only once per operation and use
+        # that snapshot throughout.
 
     class OnDemandUpdater(threading.Thread):
         """
@@ -103,61 +149,117 @@ class AWSBidAdvisor(object):
             threading.Thread.__init__(self)
             assert bid_advisor, "BidAdvisor can't be None"
             self.bid_advisor = bid_advisor
-
-        def parse_price_row(self, row):
-            region_full_name = AWS_REGIONS[self.bid_advisor.region]
-            if HOURLY_TERM_CODE + "." + RATE_CODE in row["RateCode"] and \
-                    "OnDemand" in row["TermType"] and \
-                    "On Demand" in row["PriceDescription"] and \
-                    region_full_name in row["Location"] and \
-                    row["Operating System"] == "Linux" and \
-                    row["Pre Installed S/W"] == "NA" and \
-                    row["Tenancy"] == "Shared":
-                price = row["PricePerUnit"]
-                instance_type = row["Instance Type"]
-                old_price = self.bid_advisor.on_demand_price_dict.get(instance_type, None)
-                if old_price is None:
-                    self.bid_advisor.on_demand_price_dict[instance_type] = price
-                else:
-                    if float(price) == 0.00:
+            # The filters don't change between refreshes, so they are only
+            # built once.
+            self.price_filters = [
+                {'Type': 'TERM_MATCH', 'Field': 'location',
+                 'Value': AWS_REGIONS[bid_advisor.region]},
+                {'Type': 'TERM_MATCH', 'Field': 'operatingSystem',
+                 'Value': 'Linux'},
+                {'Type': 'TERM_MATCH', 'Field': 'tenancy',
+                 'Value': 'Shared'},
+                {'Type': 'TERM_MATCH', 'Field': 'preInstalledSw',
+                 'Value': 'NA'},
+                {'Type': 'TERM_MATCH', 'Field': 'capacitystatus',
+                 'Value': 'Used'}]
+
+        def parse_price_item(self, price_item, price_dict):
+            """
+            Parses one product returned by the Pricing API and records its
+            on-demand hourly price in price_dict.
+            """
+            product = json.loads(price_item)
+            instance_type = product["product"]["attributes"]["instanceType"]
+            for term in product["terms"].get("OnDemand", {}).values():
+                for dimension in term["priceDimensions"].values():
+                    price = float(dimension["pricePerUnit"]["USD"])
+                    old_price = price_dict.get(instance_type, None)
+                    if old_price is None:
+                        price_dict[instance_type] = price
+                    elif price == 0.00:
                         logger.info("Found on-demand instance price of 0 for {}. Ignoring ...".format(instance_type))
-                    elif float(price) > float(old_price):
+                    elif price > old_price:
                         logger.info("Found alternate price for {}. Old price {}, new price {}. Updated!".format(
                             instance_type, old_price, price))
-                        self.bid_advisor.on_demand_price_dict[instance_type] = price
+                        price_dict[instance_type] = price
+
+        def get_instance_families(self):
+            """ Returns the EC2 instance families known to the Pricing API. """
+            paginator = self.bid_advisor.pricing.get_paginator(
+                'get_attribute_values')
+            pages = paginator.paginate(ServiceCode='AmazonEC2',
+                                       AttributeName='instanceFamily')
+            return [attribute_value['Value'] for page in pages
+                    for attribute_value in page['AttributeValues']]
+
+        def get_products_pricing(self, term_filters):
+            """
+            Returns the on-demand pricing info for the products matching
+            price_filters and term_filters. term_filters is a dict of
+            {field: value} to match on.
+            """
+            filters = self.price_filters + [
+                {'Type': 'TERM_MATCH', 'Field': field, 'Value': value}
+                for field, value in term_filters.items()]
+            paginator = self.bid_advisor.pricing.get_paginator('get_products')
+            pages = paginator.paginate(ServiceCode='AmazonEC2',
+                                       Filters=filters)
+            price_dict = {}
+            for page in pages:
+                for price_item in page['PriceList']:
+                    self.parse_price_item(price_item, price_dict)
+            return price_dict
 
         @retry(wait_exponential_multiplier=1000, stop_max_attempt_number=3)
         def get_on_demand_pricing(self):
             """ Issues the AWS api for getting on-demand pricing info. """
-            resp = requests.get(url=AWS_PRICING_URL, stream=True)
-            line_iterator = resp.iter_lines()
-            line = None
-            for line in line_iterator:
-                # Ignore lines till the PriceDescription is reached.
-                if "PriceDescription" in line:
-                    line = line.replace('"', '')
-                    break
-            assert line, "Failed while iteration over on-demand price info"
-            reader = csv.DictReader(line_iterator, fieldnames=line.split(','))
-            for row in reader:
-                self.parse_price_row(row)
+            # Paging through the products is sequential. So, the products are
+            # split up by instance family and the families are fetched in
+            # parallel. An instance type only belongs to one family.
+            try:
+                instance_families = self.get_instance_families()
+            except Exception as ex:
+                logger.info("Error while getting instance families: " +
+                            str(ex) + ". Getting all instance types at once")
+                instance_families = []
+            on_demand_price_dict = {}
+            with ThreadPoolExecutor(max_workers=PRICING_API_MAX_WORKERS) as executor:
+                # Products without an instance family aren't in any of the
+                # family shards. So, all the products are also fetched in one
+                # unsharded pass, which only fills in the instance types that
+                # the shards missed.
+                all_products = executor.submit(self.get_products_pricing, {})
+                shards = [{'instanceFamily': instance_family}
+                          for instance_family in instance_families]
+                for price_dict in executor.map(self.get_products_pricing,
+                                               shards):
+                    on_demand_price_dict.update(price_dict)
+                for instance_type, price in all_products.result().items():
+                    on_demand_price_dict.setdefault(instance_type, price)
+            self.bid_advisor.on_demand_price_dict = on_demand_price_dict
+            self.bid_advisor.invalidate_bid_cache()
+            if on_demand_price_dict and self.bid_advisor.spot_price_list:
+                self.bid_advisor.initial_data_event.set()
 
             logger.info("On-demand pricing info updated")
 
         def run(self):
             """ Main method of the OnDemandUpdater thread. """
-            orig_interval = self.bid_advisor.on_demand_refresh_interval
+            # The backoff is kept locally, so that the configured refresh
+            # interval is left untouched.
+            retry_interval = RETRY_INTERVAL
             while self.bid_advisor.terminate_thread is False:
                 try:
                     self.get_on_demand_pricing()
-                    self.bid_advisor.on_demand_refresh_interval = orig_interval
+                    interval = self.bid_advisor.on_demand_refresh_interval
+                    retry_interval = RETRY_INTERVAL
                 except Exception as ex:
                     logger.info("Error while getting on-demand price " +
                                     "info: " + str(ex))
-                    logger.info("Retrying after 2 minutes")
-                    self.bid_advisor.on_demand_refresh_interval = 2 * SECONDS_PER_MINUTE
-                finally:
-                    time.sleep(self.bid_advisor.on_demand_refresh_interval)
+                    logger.info("Retrying after %d seconds", retry_interval)
+                    interval = retry_interval
+                    retry_interval = min(2 * retry_interval, MAX_RETRY_INTERVAL)
+                self.bid_advisor.shutdown_event.wait(jittered(interval))
 
     class SpotInstancePriceUpdater(threading.Thread):
         """
@@ -172,72 +274,88 @@ class AWSBidAdvisor(object):
         def ec2_get_spot_price_history(self):
             ec2 = self.bid_advisor.ec2
             hour_ago = datetime.now() - timedelta(hours=1)
-            spot_price_info = []
-            next_token = ''
-            while True:
-                try:
-                    response = ec2.describe_spot_price_history(
-                        ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
-                        StartTime=hour_ago, NextToken=next_token)
-                    if response is None:
-                        raise Exception("Failed to get spot-instance prices")
-                    spot_price_info += response['SpotPriceHistory']
-                    if response['NextToken']:
-                        next_token = response['NextToken']
-                    else:
-                        return spot_price_info
-                except Exception as ex:
-                    raise Exception("Failed to get spot instance pricing info: " + str(ex))
+            filters = {}
+            # Only spot prices of instance types with a known on-demand price
+            # are useful for bidding.
+            instance_types = list(self.bid_advisor.on_demand_price_dict.keys())
+            if instance_types:
+                filters["InstanceTypes"] = instance_types
+            paginator = ec2.get_paginator('describe_spot_price_history')
+            pages = paginator.paginate(
+                ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
+                StartTime=hour_ago, PaginationConfig={'PageSize': 1000},
+                **filters)
+            return [price_info for page in pages
+                    for price_info in page['SpotPriceHistory']]
 
         def get_spot_price_info(self):
             """ Issues AWS apis to get spot instance prices. """
             spot_price_info = self.ec2_get_spot_price_history()
-            with self.bid_advisor.lock:
-                self.bid_advisor.spot_price_list = spot_price_info
+            # The spot price list is sorted by time, newest first. So the
+            # first entry seen for an instance-type and zone is the latest.
+            spot_price_index = {}
+            for price_info in spot_price_info:
+                key = (price_info["InstanceType"], price_info["AvailabilityZone"])
+                if key not in spot_price_index:
+                    spot_price_index[key] = float(price_info["SpotPrice"])
+            # Bids are computed from spot_price_index. Rebind it first so
+            # that whoever sees the new spot_price_list also sees the new
+            # index.
+            self.bid_advisor.spot_price_index = spot_price_index
+            self.bid_advisor.spot_price_list = spot_price_info
+            self.bid_advisor.invalidate_bid_cache()
+            if spot_price_info and self.bid_advisor.on_demand_price_dict:
+                self.bid_advisor.initial_data_event.set()
             logger.info("Spot instance pricing info updated")
 
         def run(self):
             """ Main method of the SpotInstancePriceUpdater thread. """
+            # The backoff is kept locally, so that the configured refresh
+            # interval is left untouched.
+            retry_interval = RETRY_INTERVAL
             while self.bid_advisor.terminate_thread is False:
                 try:
                     self.get_spot_price_info()
+                    interval = self.bid_advisor.spot_refresh_interval
+                    retry_interval = RETRY_INTERVAL
                 except Exception as ex:
-                    raise Exception("Error while getting spot-instance " +
-                                    "price info: " + str(ex))
-                finally:
-                    time.sleep(self.bid_advisor.spot_refresh_interval)
+                    logger.info("Error while getting spot-instance " +
+                                "price info: " + str(ex))
+                    logger.info("Retrying after %d seconds", retry_interval)
+                    interval = retry_interval
+                    retry_interval = min(2 * retry_interval, MAX_RETRY_INTERVAL)
+                self.bid_advisor.shutdown_event.wait(jittered(interval))
 
     def run(self):
         """ Main method of the AWSBidAdvisor. """
-        if self.all_bid_advisor_threads:
-            logger.debug("BidAdvisor already running!")
-            return
+        with self.threads_lock:
+            if self.all_bid_advisor_threads:
+                logger.debug("BidAdvisor already running!")
+                return
+
+            logger.info("Starting the BidAdvisor")
 
-        logger.info("Starting the BidAdvisor")
+            # The BidAdvisor may be restarted after a shutdown().
+            self.terminate_thread = False
+            self.shutdown_event.clear()
 
-        # The on_demand_thread and spot_instance_thread are run in Daemon mode.
-        # These threads will be run forever but shouldn't cause problems when
-        # the minion-manager process is terminated.
-        on_demand_thread = self.OnDemandUpdater(self)
-        on_demand_thread.setDaemon(True)
-        self.all_bid_advisor_threads.append(on_demand_thread)
+            # The on_demand_thread and spot_instance_thread are run in Daemon
+            # mode. These threads will be run forever but shouldn't cause
+            # problems when the minion-manager process is terminated.
+            on_demand_thread = self.OnDemandUpdater(self)
+            on_demand_thread.daemon = True
+            self.all_bid_advisor_threads.append(on_demand_thread)
 
-        spot_instance_thread = self.SpotInstancePriceUpdater(self)
-        spot_instance_thread.setDaemon(True)
-        self.all_bid_advisor_threads.append(spot_instance_thread)
+            spot_instance_thread = self.SpotInstancePriceUpdater(self)
+            spot_instance_thread.daemon = True
+            self.all_bid_advisor_threads.append(spot_instance_thread)
 
-        on_demand_thread.start()
-        spot_instance_thread.start()
+            on_demand_thread.start()
+            spot_instance_thread.start()
 
         # Wait for the threads to get pricing information.
-        while True:
+        while not self.initial_data_event.wait(INITIAL_DATA_LOG_INTERVAL):
             logger.info("Waiting for initial pricing information...")
-            try:
-                with self.lock:
-                    if self.on_demand_price_dict and self.spot_price_list:
-                        return
-            finally:
-                time.sleep(SECONDS_PER_MINUTE)
 
     def basic_bid_strategy(self, spot_price, on_demand_price, bid_options):
         """
@@ -275,40 +393,43 @@ class AWSBidAdvisor(object):
         Returns the current price for on-demand and spot-instances.
         """
         price_map = {}
-        with self.lock:
-            price_map["on-demand"] = self.on_demand_price_dict
-            price_map["spot"] = self.spot_price_list
+        price_map["on-demand"] = self.on_demand_price_dict
+        price_map["spot"] = self.spot_price_list
         return price_map
 
     def get_on_demand_price(self, instance_type):
         """
         Returns the price for on-demand instances of the given type.
         """
-        if instance_type in self.on_demand_price_dict.keys():
-            return float(self.on_demand_price_dict[instance_type])
-
-        return None
+        return self.on_demand_price_dict.get(instance_type)
 
     def get_spot_instance_price(self, instance_type, zone):
         """
         Returns the spot-instance price for the given instance_type and zone.
         """
-        # The spot price list is sorted by time. Find the latest instance
-        # for the zone and instance_type and use that as the spot price.
-        for price_info in self.spot_price_list:
-            if price_info["InstanceType"] == instance_type and \
-                    price_info["AvailabilityZone"] == zone:
-                return float(price_info["SpotPrice"])
-        return None
-
-    def get_max_spot_prices_from_zones(self, instance_type, zones):
-        max_spot_price = 0.0
-        for zone in zones:
-            tmp = self.get_spot_instance_price(instance_type, zone)
-            if tmp > max_spot_price:
-                max_spot_price = tmp
-
-        return max_spot_price
+        return self.spot_price_index.get((instance_type, zone))
+
+    def get_max_spot_prices_from_zones(self, instance_type, zones,
+                                       spot_price_index=None):
+        """
+        Returns the highest spot-instance price for the given instance_type
+        across the given zones. Zones without pricing info are ignored. If
+        none of the zones have pricing info, returns None.
+
+        Looks the prices up in spot_price_index if given, or in the latest
+        self.spot_price_index otherwise.
+        """
+        if spot_price_index is None:
+            spot_price_index = self.spot_price_index
+        prices = [price for price in
+                  (spot_price_index.get((instance_type, zone)) for zone in zones)
+                  if price is not None]
+        return max(prices) if prices else None
+
+    def invalidate_bid_cache(self):
+        """ Drops all the bids cached by get_new_bid(). """
+        with self.bid_cache_lock:
+            self.bid_cache = {}
 
     def get_new_bid(self, zones, instance_type):
         """
@@ -319,41 +440,73 @@ class AWSBidAdvisor(object):
         If the input has multiple zones, consider the highest bid from among
         the gives zones.
 
+        Bids are cached till the next pricing refresh, or for at most
+        spot_refresh_interval seconds.
+
         :param zones: The availability zones in which to check pricing.
         :param instance_type: The type of the EC2 instance.
         :return bid_info: A dictionary with necessary bidding information.
         """
 
-        with self.lock:
-            if not self.on_demand_price_dict or not self.spot_price_list:
-                logger.info("Pricing data not available! Using DEFAULT_BID")
-                return DEFAULT_BID
-
-            spot_price = self.get_max_spot_prices_from_zones(instance_type, zones)
+        # The updaters install new prices before invalidating the cache. So
+        # the cache has to be read before the prices: a bid computed from
+        # prices older than bid_cache is then never stored in it.
+        bid_cache = self.bid_cache
+        on_demand_price_dict = self.on_demand_price_dict
+        spot_price_index = self.spot_price_index
+        if not on_demand_price_dict or not spot_price_index:
+            logger.info("Pricing data not available! Using DEFAULT_BID")
+            return dict(DEFAULT_BID)
+
+        # Callers get their own copy of the cached bid_info.
+        cache_key = (instance_type, frozenset(zones))
+        cached_bid = bid_cache.get(cache_key)
+        if cached_bid is not None and cached_bid[0] > time.time():
+            return dict(cached_bid[1])
+
+        bid_info = self.compute_new_bid(zones, instance_type,
+                                        on_demand_price_dict, spot_price_index)
+        with self.bid_cache_lock:
+            # Don't store the bid if the cache was invalidated meanwhile.
+            if bid_cache is self.bid_cache:
+                bid_cache[cache_key] = (
+                    time.time() + self.spot_refresh_interval, bid_info)
+        return dict(bid_info)
+
+    def compute_new_bid(self, zones, instance_type, on_demand_price_dict,
+                        spot_price_index):
+        """
+        Computes the bid for get_new_bid() from the given snapshot of the
+        on-demand and spot-instance prices.
+        """
+        spot_price = self.get_max_spot_prices_from_zones(
+            instance_type, zones, spot_price_index)
 
-            on_demand_price = self.get_on_demand_price(instance_type)
+        on_demand_price = on_demand_price_dict.get(instance_type)
 
-            if spot_price is None:
-                logger.error("Spot price info not found. Using DEFAULT_BID")
-                return DEFAULT_BID
-            if on_demand_price is None:
-                logger.error("On demand price info not found. " +
-                             "Using DEFAULT_BID")
-                return DEFAULT_BID
+        if spot_price is None:
+            logger.error("Spot price info not found. Using DEFAULT_BID")
+            return DEFAULT_BID
+        if on_demand_price is None:
+            logger.error("On demand price info not found. " +
+                         "Using DEFAULT_BID")
+            return DEFAULT_BID
 
-            logger.info("Using spot_instance price %f, on-demand price %f " +
-                        "for instance type: %s, zones: %s",
-                        spot_price, on_demand_price, instance_type, zones)
+        logger.info("Using spot_instance price %f, on-demand price %f " +
+                    "for instance type: %s, zones: %s",
+                    spot_price, on_demand_price, instance_type, zones)
 
-            bid_options = {"spot_to_on_demand_threshold": 0.8}
-            return self.basic_bid_strategy(spot_price, on_demand_price,
-                                           bid_options)
+        bid_options = {"spot_to_on_demand_threshold": 0.8}
+        return self.basic_bid_strategy(spot_price, on_demand_price,
+                                       bid_options)
 
     def shutdown(self):
         """ Sets the flag to terminate all threads. """
-        self.terminate_thread = True
-        for thread in self.all_bid_advisor_threads:
-            thread.join()
+        with self.threads_lock:
+            self.terminate_thread = True
+            self.shutdown_event.set()
+            for thread in self.all_bid_advisor_threads:
+                thread.join()
 
-        del self.all_bid_advisor_threads[:]
+            del self.all_bid_advisor_threads[:]
         logger.info("BidAdvisor has left the building!")
@@ -1,29 +1,66 @@
 """The file has unit tests for the AWSBidAdvisor."""
 
+import json
 import unittest
 from mock import patch, MagicMock
 import datetime
 from dateutil.tz import tzutc
-from cloud_provider.aws.aws_bid_advisor import AWSBidAdvisor
+from cloud_provider.aws.aws_bid_advisor import (
+    AWSBidAdvisor, DEFAULT_BID, RETRY_INTERVAL)
 
 REFRESH_INTERVAL = 10
 REGION = 'us-west-2'
 MOCK_SPOT_PRICE={'NextToken': '', 'SpotPriceHistory': [{'AvailabilityZone': 'us-west-2b', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.300000', 'Timestamp': datetime.datetime(2019, 7, 13, 20, 30, 22, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2c', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.291400', 'Timestamp': datetime.datetime(2019, 7, 13, 20, 13, 34, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2a', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.320100', 'Timestamp': datetime.datetime(2019, 7, 13, 18, 33, 30, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2c', 'InstanceType': 'm3.medium', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.006700', 'Timestamp': datetime.datetime(2019, 7, 13, 17, 7, 9, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2b', 'InstanceType': 'm3.medium', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.006700', 'Timestamp': datetime.datetime(2019, 7, 13, 17, 7, 9, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2a', 'InstanceType': 'm3.medium', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.006700', 'Timestamp': datetime.datetime(2019, 7, 13, 17, 7, 9, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2b', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.300400', 'Timestamp': datetime.datetime(2019, 7, 13, 15, 46, 1, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2c', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.291500', 'Timestamp': datetime.datetime(2019, 7, 13, 14, 47, 14, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2a', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.321600', 'Timestamp': datetime.datetime(2019, 7, 13, 13, 40, 47, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2d', 'InstanceType': 'm5.4xlarge', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.270400', 'Timestamp': datetime.datetime(2019, 7, 13, 6, 23, 5, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2c', 'InstanceType': 'm3.medium', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.006700', 'Timestamp': datetime.datetime(2019, 7, 12, 17, 7, 5, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2b', 'InstanceType': 'm3.medium', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.006700', 'Timestamp': datetime.datetime(2019, 7, 12, 17, 7, 5, tzinfo=tzutc())}, {'AvailabilityZone': 'us-west-2a', 'InstanceType': 'm3.medium', 'ProductDescription': 'Linux/UNIX', 'SpotPrice': '0.006700', 'Timestamp': datetime.datetime(2019, 7, 12, 17, 7, 5, tzinfo=tzutc())}], 'ResponseMetadata': {'RequestId': 'f428bcba-016f-476f-b9ed-755f71af2d36', 'HTTPStatusCode': 200, 'HTTPHeaders': {'content-type': 'text/xml;charset=UTF-8', 'content-length': '4341', 'vary': 'accept-encoding', 'date': 'Sun, 14 Jul 2019 00:45:52 GMT', 'server': 'AmazonEC2'}, 'RetryAttempts': 0}}
 
 
+def _price_item(instance_type, price):
+    """ Returns a product as returned by the Pricing API. """
+    return json.dumps({
+        "product": {"attributes": {"instanceType": instance_type,
+                                   "location": "US West (Oregon)"}},
+        "terms": {"OnDemand": {"SKU.JRTCKXETXF": {"priceDimensions": {
+            "SKU.JRTCKXETXF.6YS6EN2CT7": {
+                "unit": "Hrs", "pricePerUnit": {"USD": price}}}}}}})
+
+
+MOCK_ON_DEMAND_PRICE = {"m5.4xlarge": "0.768", "m3.medium": "0.067"}
+
+
+def _mock_pricing(bidadv):
+    """ Makes bidadv get MOCK_ON_DEMAND_PRICE from the Pricing API. """
+    def _paginate(**kwargs):
+        if "AttributeName" in kwargs:
+            return [{"AttributeValues": []}]
+        return [{"PriceList": [_price_item(instance_type, price)
+                               for instance_type, price in
+                               MOCK_ON_DEMAND_PRICE.items()]}]
+
+    bidadv.pricing = MagicMock()
+    bidadv.pricing.get_paginator.return_value.paginate.side_effect = _paginate
+
+
 class AWSBidAdvisorTest(unittest.TestCase):
     """
     Tests for AWSBidAdvisor.
     """
-    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE))
+    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE['SpotPriceHistory']))
     def test_ba_lifecycle(self):
         """
         Tests that the AWSBidVisor starts threads and stops them correctly.
         """
         bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        _mock_pricing(bidadv)
+        assert len(bidadv.all_bid_advisor_threads) == 0
+        bidadv.run()
+        assert len(bidadv.all_bid_advisor_threads) == 2
+        bidadv.shutdown()
         assert len(bidadv.all_bid_advisor_threads) == 0
+        assert bidadv.shutdown_event.is_set()
+
+        # The BidAdvisor can be restarted after a shutdown.
         bidadv.run()
         assert len(bidadv.all_bid_advisor_threads) == 2
+        assert all(thread.is_alive() for thread in bidadv.all_bid_advisor_threads)
         bidadv.shutdown()
         assert len(bidadv.all_bid_advisor_threads) == 0
 
@@ -32,12 +69,62 @@ class AWSBidAdvisorTest(unittest.TestCase):
         Tests that the AWSBidVisor correctly gets the on-demand pricing.
         """
         bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        _mock_pricing(bidadv)
         assert len(bidadv.on_demand_price_dict) == 0
         updater = bidadv.OnDemandUpdater(bidadv)
         updater.get_on_demand_pricing()
         assert len(bidadv.on_demand_price_dict) > 0
 
-    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE))
+    def test_ba_on_demand_pricing_by_family(self):
+        """
+        Tests that the AWSBidVisor merges the on-demand pricing of all the
+        instance families, and of the instance types without a family.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        family_prices = {"General purpose": ("m5.4xlarge", "0.768"),
+                         "Compute optimized": ("c5.large", "0.085")}
+
+        def _paginate(**kwargs):
+            if "AttributeName" in kwargs:
+                return [{"AttributeValues": [{"Value": family}
+                                             for family in family_prices]}]
+            filters = dict((f["Field"], f["Value"]) for f in kwargs["Filters"])
+            if "instanceFamily" not in filters:
+                # z9.large is the only product without an instance family.
+                # The unsharded pass must not override the family prices.
+                return [{"PriceList": [_price_item("m5.4xlarge", "9.99"),
+                                       _price_item("z9.large", "0.5")]}]
+            instance_type, price = family_prices[filters["instanceFamily"]]
+            return [{"PriceList": [_price_item(instance_type, price)]}]
+
+        bidadv.pricing = MagicMock()
+        bidadv.pricing.get_paginator.return_value.paginate.side_effect = _paginate
+        updater = bidadv.OnDemandUpdater(bidadv)
+        updater.get_on_demand_pricing()
+        assert bidadv.on_demand_price_dict == {"m5.4xlarge": 0.768,
+                                               "c5.large": 0.085,
+                                               "z9.large": 0.5}
+
+    def test_ba_on_demand_pricing_no_families(self):
+        """
+        Tests that the AWSBidVisor gets all the on-demand pricing at once if
+        it can't get the instance families.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+
+        def _paginate(**kwargs):
+            if "AttributeName" in kwargs:
+                raise Exception("AccessDenied")
+            assert "instanceFamily" not in [f["Field"] for f in kwargs["Filters"]]
+            return [{"PriceList": [_price_item("m5.4xlarge", "0.768")]}]
+
+        bidadv.pricing = MagicMock()
+        bidadv.pricing.get_paginator.return_value.paginate.side_effect = _paginate
+        updater = bidadv.OnDemandUpdater(bidadv)
+        updater.get_on_demand_pricing()
+        assert bidadv.on_demand_price_dict == {"m5.4xlarge": 0.768}
+
+    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE['SpotPriceHistory']))
     def test_ba_spot_pricing(self):
         """
         Tests that the AWSBidVisor correctly gets the spot instance pricing.
@@ -47,13 +134,20 @@ class AWSBidAdvisorTest(unittest.TestCase):
         updater = bidadv.SpotInstancePriceUpdater(bidadv)
         updater.get_spot_price_info()
         assert len(bidadv.spot_price_list) > 0
+        assert not bidadv.initial_data_event.is_set()
 
-    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE))
+        # The index should hold the latest price for each instance-type, AZ.
+        assert bidadv.get_spot_instance_price('m5.4xlarge', 'us-west-2b') == 0.3
+        assert bidadv.get_spot_instance_price('m5.4xlarge', 'us-west-2d') == 0.2704
+        assert bidadv.get_spot_instance_price('m5.4xlarge', 'us-east-1a') is None
+
+    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE['SpotPriceHistory']))
     def test_ba_price_update(self):
         """
         Tests that the AXBidVisor actually updates the pricing info.
         """
         bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        _mock_pricing(bidadv)
         od_updater = bidadv.OnDemandUpdater(bidadv)
         od_updater.get_on_demand_pricing()
 
@@ -63,6 +157,7 @@ class AWSBidAdvisorTest(unittest.TestCase):
         # Verify that the pricing info was populated.
         assert len(bidadv.on_demand_price_dict) > 0
         assert len(bidadv.spot_price_list) > 0
+        assert bidadv.initial_data_event.is_set()
 
         # Make the price dicts empty to check if they get updated.
         bidadv.on_demand_price_dict = {}
@@ -75,6 +170,51 @@ class AWSBidAdvisorTest(unittest.TestCase):
         assert len(bidadv.on_demand_price_dict) > 0
         assert len(bidadv.spot_price_list) > 0
 
+    def test_ba_spot_price_history(self):
+        """
+        Tests that the SpotInstancePriceUpdater pages through the spot price
+        history of instance types with known on-demand prices.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        bidadv.ec2 = MagicMock()
+        paginator = bidadv.ec2.get_paginator.return_value
+        paginator.paginate.return_value = [MOCK_SPOT_PRICE, MOCK_SPOT_PRICE]
+        updater = bidadv.SpotInstancePriceUpdater(bidadv)
+
+        spot_price_info = updater.ec2_get_spot_price_history()
+        assert len(spot_price_info) == 2 * len(MOCK_SPOT_PRICE['SpotPriceHistory'])
+        bidadv.ec2.get_paginator.assert_called_with('describe_spot_price_history')
+        assert 'InstanceTypes' not in paginator.paginate.call_args[1]
+
+        bidadv.on_demand_price_dict = {'m5.4xlarge': 0.768}
+        updater.ec2_get_spot_price_history()
+        assert paginator.paginate.call_args[1]['InstanceTypes'] == ['m5.4xlarge']
+
+    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'get_spot_price_info', MagicMock(side_effect=Exception("Throttled")))
+    def test_ba_spot_pricing_failure(self):
+        """
+        Tests that the SpotInstancePriceUpdater keeps running and backs off
+        when fetching the spot instance pricing fails.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        updater = bidadv.SpotInstancePriceUpdater(bidadv)
+        intervals = []
+
+        def _wait(interval):
+            intervals.append(interval)
+            bidadv.terminate_thread = len(intervals) == 3
+            return bidadv.terminate_thread
+
+        with patch.object(bidadv.shutdown_event, 'wait', _wait):
+            updater.run()
+
+        assert len(intervals) == 3
+        assert 0.9 * RETRY_INTERVAL <= intervals[0] <= 1.1 * RETRY_INTERVAL
+        assert 1.8 * RETRY_INTERVAL <= intervals[1] <= 2.2 * RETRY_INTERVAL
+        assert 3.6 * RETRY_INTERVAL <= intervals[2] <= 4.4 * RETRY_INTERVAL
+        # The configured refresh interval is left alone.
+        assert bidadv.spot_refresh_interval == REFRESH_INTERVAL
+
     def test_ba_get_bid(self):
         """
         Tests that the bid_advisor's get_new_bid() method returns correct
@@ -85,10 +225,8 @@ class AWSBidAdvisorTest(unittest.TestCase):
         instance_type = "m3.large"
         zones = ["us-west-2b"]
         # Manually populate the prices so that spot-instance prices are chosen.
-        bidadv.on_demand_price_dict["m3.large"] = "100"
-        bidadv.spot_price_list = [{'InstanceType': instance_type,
-                                   'SpotPrice': '80',
-                                   'AvailabilityZone': "us-west-2b"}]
+        bidadv.on_demand_price_dict["m3.large"] = 100.0
+        bidadv.spot_price_index = {(instance_type, "us-west-2b"): 80.0}
         bid_info = bidadv.get_new_bid(zones, instance_type)
         assert bid_info is not None, "BidAdvisor didn't return any " + \
             "now bid information."
@@ -96,14 +234,64 @@ class AWSBidAdvisorTest(unittest.TestCase):
         assert isinstance(bid_info["price"], str)
 
         # Manually populate the prices so that on-demand instances are chosen.
-        bidadv.spot_price_list = [{'InstanceType': instance_type,
-                                   'SpotPrice': '85',
-                                   'AvailabilityZone': "us-west-2b"}]
+        bidadv.spot_price_index = {(instance_type, "us-west-2b"): 85.0}
+        bidadv.invalidate_bid_cache()
         bid_info = bidadv.get_new_bid(zones, instance_type)
         assert bid_info is not None, "BidAdvisor didn't return any now " + \
             "bid information."
         assert bid_info["type"] == "on-demand"
 
+    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE['SpotPriceHistory']))
+    def test_ba_get_bid_cache(self):
+        """
+        Tests that get_new_bid() caches bids till the spot prices are
+        refreshed.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+
+        instance_type = "m5.4xlarge"
+        zones = ["us-west-2a", "us-west-2b"]
+        bidadv.on_demand_price_dict[instance_type] = 0.768
+        bidadv.spot_price_index = {(instance_type, "us-west-2b"): 0.3}
+        bid_info = bidadv.get_new_bid(zones, instance_type)
+        assert bid_info["type"] == "spot"
+
+        # The cached bid is returned even if the prices change underneath.
+        # Callers get their own copy of it.
+        bidadv.spot_price_index = {(instance_type, "us-west-2b"): 0.7}
+        bid_info["type"] = "on-demand"
+        assert bidadv.get_new_bid(list(reversed(zones)), instance_type)["type"] == "spot"
+
+        # Refreshing the spot prices drops the cached bids.
+        bidadv.on_demand_price_dict[instance_type] = 0.3
+        updater = bidadv.SpotInstancePriceUpdater(bidadv)
+        updater.get_spot_price_info()
+        assert bidadv.get_new_bid(zones, instance_type)["type"] == "on-demand"
+
+    def test_ba_get_bid_cache_invalidated(self):
+        """
+        Tests that a bid computed from prices that were replaced while it was
+        being computed is not cached.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+
+        instance_type = "m5.4xlarge"
+        zones = ["us-west-2b"]
+        bidadv.on_demand_price_dict = {instance_type: 0.768}
+        bidadv.spot_price_index = {(instance_type, "us-west-2b"): 0.3}
+        compute_new_bid = bidadv.compute_new_bid
+
+        def _refresh_while_computing(*args):
+            bid_info = compute_new_bid(*args)
+            bidadv.spot_price_index = {(instance_type, "us-west-2b"): 0.7}
+            bidadv.invalidate_bid_cache()
+            return bid_info
+
+        with patch.object(bidadv, 'compute_new_bid', _refresh_while_computing):
+            assert bidadv.get_new_bid(zones, instance_type)["type"] == "spot"
+        assert not bidadv.bid_cache
+        assert bidadv.get_new_bid(zones, instance_type)["type"] == "on-demand"
+
     def test_ba_get_bid_no_data(self):
         """
         Tests that the BidAdvisor returns the default if the pricing
@@ -113,12 +301,35 @@ class AWSBidAdvisorTest(unittest.TestCase):
         bid_info = bidadv.get_new_bid(['us-west-2a'], 'm3.large')
         assert bid_info["type"] == "on-demand"
 
-    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE))
+        # Callers get a copy, not DEFAULT_BID itself.
+        assert bid_info is not DEFAULT_BID
+
+    def test_ba_get_bid_no_spot_price(self):
+        """
+        Tests that the BidAdvisor returns the default if there is no spot
+        price for any of the given zones.
+        """
+        bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+
+        instance_type = "m3.large"
+        bidadv.on_demand_price_dict[instance_type] = 100.0
+        bidadv.spot_price_index = {(instance_type, "us-west-2b"): 80.0}
+
+        assert bidadv.get_max_spot_prices_from_zones(
+            instance_type, ["us-west-2a", "us-west-2b"]) == 80.0
+        assert bidadv.get_max_spot_prices_from_zones(
+            instance_type, ["us-west-2a", "us-west-2c"]) is None
+
+        bid_info = bidadv.get_new_bid(["us-west-2a"], instance_type)
+        assert bid_info["type"] == "on-demand"
+
+    @patch.object(AWSBidAdvisor.SpotInstancePriceUpdater, 'ec2_get_spot_price_history', MagicMock(return_value=MOCK_SPOT_PRICE['SpotPriceHistory']))
     def test_ba_get_current_price(self):
         """
         Tests that the BidAdvisor returns the most recent price information.
         """
         bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
+        _mock_pricing(bidadv)
 
         od_updater = bidadv.OnDemandUpdater(bidadv)
         od_updater.get_on_demand_pricing()
@@ -134,37 +345,29 @@ class AWSBidAdvisorTest(unittest.TestCase):
         assert price_info_map["spot"] is not None
         assert price_info_map["on-demand"] is not None
 
-    def test_ba_parse_row(self):
+    def test_ba_parse_price_item(self):
         """
-        Tests that the BidAdvisor parses the rows in on-demand price information.
+        Tests that the BidAdvisor parses the products in on-demand price information.
         """
         bidadv = AWSBidAdvisor(REFRESH_INTERVAL, REFRESH_INTERVAL, REGION)
 
         od_updater = bidadv.OnDemandUpdater(bidadv)
-        row = {}
-        row['RateCode'] = "JRTCKXETXF.6YS6EN2CT7"
-        row["TermType"] = "OnDemand"
-        row["PriceDescription"] = "On Demand Linux"
-        row["Location"] = "US West (Oregon)"
-        row["Operating System"] = "Linux"
-        row["Pre Installed S/W"] = "NA"
-        row["Tenancy"] = "Shared"
-        row["PricePerUnit"] = "0.453"
-        row["Instance Type"] = "m5.4xlarge"
-
-        od_updater.parse_price_row(row)
-        assert od_updater.bid_advisor.on_demand_price_dict['m5.4xlarge'] == "0.453"
-
-        od_updater.parse_price_row(row)
-        assert od_updater.bid_advisor.on_demand_price_dict['m5.4xlarge'] == "0.453"
-
-        row["PricePerUnit"] = "0.658"
-        od_updater.parse_price_row(row)
-        assert od_updater.bid_advisor.on_demand_price_dict['m5.4xlarge'] == "0.658"
-
-        row["PricePerUnit"] = "0.00"
-        od_updater.parse_price_row(row)
-        assert od_updater.bid_advisor.on_demand_price_dict['m5.4xlarge'] == "0.658"
-
-        row['RateCode'] = "Some Random RateCode"
-        od_updater.parse_price_row(row)
+        price_dict = {}
+
+        od_updater.parse_price_item(_price_item("m5.4xlarge", "0.453"), price_dict)
+        assert price_dict['m5.4xlarge'] == 0.453
+
+        od_updater.parse_price_item(_price_item("m5.4xlarge", "0.453"), price_dict)
+        assert price_dict['m5.4xlarge'] == 0.453
+
+        od_updater.parse_price_item(_price_item("m5.4xlarge", "0.658"), price_dict)
+        assert price_dict['m5.4xlarge'] == 0.658
+
+        od_updater.parse_price_item(_price_item("m5.4xlarge", "0.00"), price_dict)
+        assert price_dict['m5.4xlarge'] == 0.658
+
+        # Products without on-demand terms are ignored.
+        od_updater.parse_price_item(json.dumps({
+            "product": {"attributes": {"instanceType": "m5.large"}},
+            "terms": {"Reserved": {}}}), price_dict)
+        assert 'm5.large' not in price_dict
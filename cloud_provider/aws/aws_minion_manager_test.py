@@ -289,10 +289,8 @@ class AWSMinionManagerTest(unittest.TestCase):
             # Set instanceType since moto's instances don't have it.
             instance_type = "m3.medium"
             zone = "us-west-2b"
-            awsmm.bid_advisor.on_demand_price_dict[instance_type] = "100"
-            awsmm.bid_advisor.spot_price_list = [{'InstanceType': instance_type,
-                                                'SpotPrice': '80',
-                                                'AvailabilityZone': zone}]
+            awsmm.bid_advisor.on_demand_price_dict[instance_type] = 100.0
+            awsmm.bid_advisor.spot_price_index = {(instance_type, zone): 80.0}
             for instance in asg_meta.get_instances():
                 instance.InstanceType = instance_type
             awsmm.populate_instances(asg_meta)
@@ -322,10 +320,8 @@ class AWSMinionManagerTest(unittest.TestCase):
             # Set instanceType since moto's instances don't have it.
             instance_type = "m3.medium"
             zone = "us-west-2b"
-            awsmm.bid_advisor.on_demand_price_dict[instance_type] = "100"
-            awsmm.bid_advisor.spot_price_list = [{'InstanceType': instance_type,
-                                                  'SpotPrice': '80',
-                                                  'AvailabilityZone': zone}]
+            awsmm.bid_advisor.on_demand_price_dict[instance_type] = 100.0
+            awsmm.bid_advisor.spot_price_index = {(instance_type, zone): 80.0}
             for instance in asg_meta.get_instances():
                 instance.InstanceType = instance_type
             awsmm.populate_instances(asg_meta)